@@ -8,6 +8,47 @@ from pascal_voc_loader import PascalVOCLoader
 from torch.utils.data.sampler import SubsetRandomSampler
 
 
+def collate_padded(samples):
+    # every sample carries one entry per object in the image, so the per-label
+    # lists are padded with zeros to the largest label count in the batch.
+    # 'label/present' is an (N, B) mask marking the real (label, sample) pairs
+    num_labels = max(len(s['label/onehot']) for s in samples)
+    if num_labels == 0:
+        raise ValueError('No sample in the batch has any labels')
+    present = torch.zeros(num_labels, len(samples))
+    for b, s in enumerate(samples):
+        present[:len(s['label/onehot']), b] = 1
+
+    out = {
+        'image': torch.stack([s['image'] for s in samples]),
+        'label/present': present
+    }
+    for key in ('label/onehot', 'label/truths', 'label/masks'):
+        # e.g. the circle masks may be missing for every image in the batch,
+        # keep the default collate's empty list for that key
+        ref = next((s[key][0] for s in samples if len(s[key])), None)
+        if ref is None:
+            out[key] = []
+            continue
+        out[key] = [
+            torch.stack([
+                s[key][n] if n < len(s[key]) else torch.zeros_like(ref)
+                for s in samples
+            ]) for n in range(num_labels)
+        ]
+    out['label/idx'] = [
+        torch.tensor([
+            s['label/idx'][n] if n < len(s['label/idx']) else -1
+            for s in samples
+        ]) for n in range(num_labels)
+    ]
+    out['label/name'] = [[
+        s['label/name'][n] if n < len(s['label/name']) else ''
+        for s in samples
+    ] for n in range(num_labels)]
+    return out
+
+
 class RawDataset:
     def __init__(self,
                  root_dir,
@@ -17,7 +58,8 @@ class RawDataset:
                  output_dims=224,
                  output_channels=3,
                  shuffle=True,
-                 batch_size_dict=None):
+                 batch_size_dict=None,
+                 pin_memory=False):
         self.name = os.path.basename(os.path.normpath(root_dir))
         self.output_dims = output_dims
         self.output_channels = output_channels
@@ -25,7 +67,7 @@ class RawDataset:
         self.root_dir = root_dir
         self.num_workers = num_workers
         if not batch_size_dict:
-            self.batch_size = {'train': 1, 'test': 1}
+            batch_size_dict = {'train': 1, 'test': 1}
         self.batch_size = batch_size_dict
 
         self.dataset = PascalVOCLoader(
@@ -48,15 +90,23 @@ class RawDataset:
         train_sampler = SubsetRandomSampler(train_indices)
         valid_sampler = SubsetRandomSampler(val_indices)
 
+        # keep the workers alive between epochs and hand back page-locked
+        # batches so the host to device copies can run asynchronously
+        loader_kwargs = {
+            'num_workers': self.num_workers,
+            'pin_memory': pin_memory,
+            'persistent_workers': self.num_workers > 0,
+            'collate_fn': collate_padded
+        }
         train_loader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=self.batch_size['train'],
-            num_workers=0,
-            sampler=train_sampler)
+            sampler=train_sampler,
+            **loader_kwargs)
         validation_loader = torch.utils.data.DataLoader(
             self.dataset,
-            num_workers=0,
             batch_size=self.batch_size['test'],
-            sampler=valid_sampler)
+            sampler=valid_sampler,
+            **loader_kwargs)
 
         self.datasets = {'train': train_loader, 'test': validation_loader}
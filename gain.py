@@ -1,11 +1,12 @@
 import torch
 import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 from datetime import datetime
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import cv2
-import re
 import io
 import json
 import math
@@ -13,13 +14,18 @@ import models
 from tensorboardX import SummaryWriter
 import tqdm
 
-model_file_reg = re.compile(
-    r'saved_model_(?P<epoch>\d+)_(?P<tag>[a-zA-Z0-9-_]+)\.model')
-
-
-def scalar(tensor):
-    return tensor.data.cpu().item()
 
+@torch.jit.script
+def _mask_image_fused(gcam, image, omega: float, sigma: float):
+    # Eq 4, scripted so that the scale -> sigmoid -> mask chain is fused into
+    # a single elementwise kernel. gcam is scaled over its last three dims, so
+    # every (1, H, W) map gets its own scale, per sample and per label
+    dims = [-3, -2, -1]
+    gcam_min = gcam.amin(dim=dims, keepdim=True)
+    gcam_max = gcam.amax(dim=dims, keepdim=True)
+    scaled_gcam = (gcam - gcam_min) / (gcam_max - gcam_min + 1e-5)
+    mask = torch.sigmoid(omega * (scaled_gcam - sigma))
+    return image * (1 - mask)
 
 
 class AttentionGAIN:
@@ -37,7 +43,9 @@ class AttentionGAIN:
                  labels=None,
                  input_channels=None,
                  input_dims=None,
-                 batch_norm=True):
+                 batch_norm=True,
+                 amp_dtype=None,
+                 compile_mode=None):
 
         # validation
         if not model_type:
@@ -51,6 +59,12 @@ class AttentionGAIN:
 
         # set gpu options
         self.gpu = gpu
+        self.device = torch.device('cuda' if self.gpu else 'cpu')
+
+        # mixed precision options, only used on the gpu
+        if amp_dtype not in (None, 'bfloat16', 'float16'):
+            raise ValueError('Unsupported amp_dtype %s' % str(amp_dtype))
+        self.amp_dtype = getattr(torch, amp_dtype) if amp_dtype else None
 
         # define model
         self.model_type = model_type
@@ -66,17 +80,32 @@ class AttentionGAIN:
             raise ValueError('epoch_offset > 0, but no weights were supplied')
 
         if self.gpu:
+            # GAIN allocates a differently sized set of maps and masked images
+            # per sample, so let the caching allocator grow segments in place
+            # rather than fragmenting into many fixed-size blocks. older torch
+            # (< 2.1) has no such setting and keeps the default allocator
+            if hasattr(torch.cuda.memory, '_set_allocator_settings'):
+                torch.cuda.memory._set_allocator_settings(
+                    'expandable_segments:True')
             self.model = self.model.cuda()
             self.tensor_source = torch.cuda
         else:
             self.tensor_source = torch
 
+        # batching the masked forward over labels would change what batch
+        # norm layers normalise over, so it is only done without them
+        self._has_batch_norm = any(
+            isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+            for m in self.model.modules())
+
         # wire up our hooks for heatmap creation
         self._register_hooks(gradient_layer_name)
+        if compile_mode:
+            self._compile_gradient_layer(gradient_layer_name, compile_mode)
 
         # create loss function
         # TODO make this configurable
-        self.loss_cl = torch.nn.BCEWithLogitsLoss()
+        self.loss_cl = torch.nn.BCEWithLogitsLoss(reduction='none')
 
         # output directory setup
         self.heatmap_dir = heatmap_dir
@@ -96,34 +125,43 @@ class AttentionGAIN:
         self.input_dims = input_dims
         self.epoch = epoch
 
+        # JET colormap as an RGB lookup table, so heatmaps are coloured with a
+        # single gather instead of a round trip through cv2.applyColorMap
+        jet = cv2.applyColorMap(
+            np.arange(256, dtype=np.uint8).reshape(-1, 1), cv2.COLORMAP_JET)
+        self._jet_lut = torch.from_numpy(
+            np.ascontiguousarray(jet.reshape(256, 3)[:, ::-1])).to(self.device)
+
+        # (tag, extension) -> [(epoch, path), ...] of the checkpoints written by
+        # _maybe_save_model, so saving never has to scan saved_model_dir
+        self._saved_models = {}
+
+        # side stream and pinned host buffer for copying heatmaps off the gpu
+        self._copy_stream = torch.cuda.Stream() if self.gpu else None
+        self._host_buf = None
+
+        # tensorboard output is buffered (scalars) or written from a worker
+        # thread (heatmaps) so it stays off the training loop's critical path
+        self._scalar_buffer = {}
+        self._executor = None
+        self._heatmap_future = None
+
     @staticmethod
     def load(model_path, **kwargs):
         model_dict = torch.load(model_path)
         return AttentionGAIN(weights=model_dict['state_dict'], **kwargs)
 
-    @staticmethod
-    def _parse_saved_model_name(model_name):
-        result = model_file_reg.match(model_name)
-        if not result:
-            raise ValueError(
-                'Could not parse tag from model name %s' % model_name)
-
-        return result.group('epoch'), result.group('tag')
-
     def _register_hooks(self, layer_name):
-        # this wires up a hook that stores both the activation and gradient of the conv layer we are interested in
+        # this wires up a hook that stores the activation of the conv layer we are interested in. its gradient is
+        # taken directly with torch.autograd.grad, so no backward hook is needed
         def forward_hook(module, input_, output_):
             self._last_activation = output_
 
-        def backward_hook(module, grad_in, grad_out):
-            self._last_grad = grad_out[0]
-
         # locate the layer that we are concerned about
         gradient_layer_found = False
         for idx, m in self.model.named_modules():
             if idx == layer_name:
                 m.register_forward_hook(forward_hook)
-                m.register_backward_hook(backward_hook)
                 gradient_layer_found = True
                 break
 
@@ -133,6 +171,24 @@ class AttentionGAIN:
                 'Gradient layer %s not found in the internal model' %
                 layer_name)
 
+    def _compile_gradient_layer(self, layer_name, mode):
+        # compiling the whole model would fold the gradient layer into a single
+        # autograd node, leaving nothing to take the Grad-CAM gradient against.
+        # instead only the forward of that layer is compiled, which keeps its
+        # output (and our forward hook) at a graph boundary while still covering
+        # the convolutional trunk where the kernel launches are
+        if not hasattr(torch, 'compile'):
+            print('WARNING torch.compile requires torch >= 2.0, not compiling')
+            return
+
+        # the layer sees B images on the clean pass and N * B on the masked
+        # pass, with N changing per sample, so compile for dynamic shapes
+        # rather than recompiling for every new label count
+        for idx, m in self.model.named_modules():
+            if idx == layer_name:
+                m.forward = torch.compile(m.forward, mode=mode, dynamic=True)
+                break
+
     def __str__(self):
         meta_dict = self._get_meta_dict()
         ret_str = 'Metadata:'
@@ -145,31 +201,48 @@ class AttentionGAIN:
 
         return ret_str
 
+    def _autocast(self):
+        # runs the model forwards in reduced precision when enabled, anything
+        # computed from their outputs is cast back to fp32 by the caller.
+        # a cuda autocast on a cpu-only host warns even when disabled, so
+        # there is nothing to enter unless amp is actually on
+        if not self.gpu or self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type='cuda', dtype=self.amp_dtype)
+
     def _convert_data_and_label(self, data, label,
                                 extra_super=None,
-                                am_mask=None):
-        # converts our data and label over to variables, gpu optional
-        if self.gpu:
-            data = data.cuda()
-            label = [l.cuda() for l in label]
-            if(extra_super is not None):
-                extra_super = [e.cuda() for e in extra_super]
-            if(am_mask is not None):
-                am_mask = [e.cuda() for e in am_mask]
-
-        data = torch.autograd.Variable(data)
-        label = [torch.autograd.Variable(l) for l in label]
-
-        if (extra_super is not None):
-            extra_super = [torch.autograd.Variable(e) for e in extra_super]
-        if (am_mask is not None):
-            am_mask = [torch.autograd.Variable(e) for e in am_mask]
+                                am_mask=None,
+                                present=None):
+        # stacks the per-label lists into (N, B, ...) tensors, gpu optional.
+        # *present* is the (N, B) mask of real labels from data.collate_padded,
+        # without one every label is taken to be present
+        # the loaders hand back pinned memory, so these copies need not block.
+        # stacking happens after the copy, a host side stack would allocate
+        # pageable memory and make the copy synchronous again
+        def convert(tensors):
+            # an empty list means the loader had nothing for this key
+            if not len(tensors):
+                return None
+            if self.gpu:
+                tensors = [t.cuda(non_blocking=True) for t in tensors]
+            return torch.stack(tensors)
 
-        return data, label, extra_super, am_mask
+        if self.gpu:
+            data = data.cuda(non_blocking=True)
+        label = convert(label)
+        if(extra_super is not None):
+            extra_super = convert(extra_super)
+        if(am_mask is not None):
+            am_mask = convert(am_mask)
+        if(present is None):
+            present = label.new_ones(label.shape[:2])
+        elif self.gpu:
+            present = present.cuda(non_blocking=True)
+
+        return data, label, extra_super, am_mask, present
 
     def _maybe_save_model(self, serialization, tag='default', save_count=1):
-        # TODO if a different save count but same tag is used in different circumstances, this will have
-        # undefined behavior (we only delete one file if there are too many, but we should be trimming to *save_count*
         if self.saved_model_dir is None:
             return
 
@@ -186,41 +259,19 @@ class AttentionGAIN:
         else:
             extension = '.pyt'
 
-        max_epoch = self.epoch
-        delete_model_path = None
-        num_models = 0
-        # store the model for later deletion
-        for p in os.listdir(self.saved_model_dir):
-            if not os.path.splitext(p)[-1] == extension:
-                continue
-
-            try:
-                temp_epoch, temp_tag = self._parse_saved_model_name(p)
-            except ValueError as e:
-                print('WARNING error while parsing saved model filename: %s' %
-                      str(e))
-                continue
-            if temp_tag != tag:
-                continue
-
-            temp_epoch = int(temp_epoch)
-            num_models += 1
-
-            if temp_epoch < max_epoch:
-                delete_model_path = os.path.join(self.saved_model_dir, p)
-                max_epoch = temp_epoch
-
-        # if we are less that the max saved model count, then don't worry about it
-        if num_models < save_count:
-            delete_model_path = None
+        # the models we have saved so far with this tag, oldest first
+        saved_models = self._saved_models.setdefault((tag, extension), [])
 
         # save the current model
         saved_model_filename = os.path.join(
             self.saved_model_dir,
             'saved_model_%i_%s%s' % (self.epoch, tag, extension))
         if serialization == 'onnx':
-            dummy_dims = (1, self.input_channels) + self.input_dims
-            dummy_input = torch.autograd.Variable(torch.randn(dummy_dims))
+            input_hw = self.input_dims
+            if isinstance(input_hw, int):
+                input_hw = (input_hw, input_hw)
+            dummy_dims = (1, self.input_channels) + tuple(input_hw)
+            dummy_input = torch.randn(dummy_dims)
             if self.gpu:
                 dummy_input = dummy_input.cuda()
             try:
@@ -233,15 +284,24 @@ class AttentionGAIN:
 
         else:
             try:
-                torch.save(self.model.state_dict(), saved_model_filename)
+                # serialize in memory first so the file is written in one go
+                buf = io.BytesIO()
+                torch.save(self.model.state_dict(), buf)
+                with open(saved_model_filename, 'wb') as f:
+                    f.write(buf.getbuffer())
                 print('MODEL saved to %s' % saved_model_filename)
             except OSError as e:
                 print('WARNING there was an error while saving model: %s' %
                       str(e))
                 return
 
-            # delete our extra model
-            if delete_model_path:
+            if (self.epoch, saved_model_filename) not in saved_models:
+                saved_models.append((self.epoch, saved_model_filename))
+                saved_models.sort()
+
+            # delete our extra models
+            while len(saved_models) > save_count:
+                _, delete_model_path = saved_models.pop(0)
                 try:
                     os.remove(delete_model_path)
                 except OSError as e:
@@ -255,41 +315,109 @@ class AttentionGAIN:
         if self.heatmap_dir is None:
             return
 
-        heatmap_image = self._combine_heatmap_with_image(
-            image, heatmap, self.labels[label])
+        heatmap_image = self._blend_heatmap(image, heatmap)
+        I_star = (I_star.detach() * 255).clamp(0, 255).to(torch.uint8)
+        out_image = torch.cat((heatmap_image, I_star.permute(1, 2, 0)), dim=1)
 
-        I_star = (I_star.data.cpu().numpy().transpose((1, 2, 0)) * 255).astype(np.uint8)
-        out_image = np.concatenate((heatmap_image, I_star), axis=1)
+        # the previous heatmap may still be reading the pinned host buffer
+        if self._heatmap_future is not None:
+            self._heatmap_future.result()
+
+        out_image = self._copy_to_host(out_image)
+        copy_done = None
+        if self.gpu:
+            copy_done = torch.cuda.Event()
+            copy_done.record(self._copy_stream)
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._heatmap_future = self._executor.submit(
+            self._write_heatmap, out_image, self.labels[label], epoch,
+            copy_done)
+
+    def _write_heatmap(self, out_image, label_name, epoch, copy_done):
+        # runs on self._executor, so waiting for the copy, drawing the label and
+        # the png encoding in add_image all happen off the main thread
+        if copy_done is not None:
+            copy_done.synchronize()
+        out_image = self._draw_label(out_image.numpy(), label_name)
         out_image = torch.tensor(out_image.transpose((2, 0, 1)))
 
         self.writer.add_image('heatmap', out_image, epoch)
 
-    @staticmethod
-    def _combine_heatmap_with_image(image,
-                                    heatmap,
-                                    label_name,
-                                    font_scale=0.75,
-                                    font_name=cv2.FONT_HERSHEY_SIMPLEX,
-                                    font_color=(255, 255, 255),
-                                    font_pixel_width=1):
-
-
-        image = image.data.cpu().numpy().transpose((1, 2, 0)) * 255
-        image = image.astype(np.uint8)
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    def _finish_heatmaps(self, raise_errors=True):
+        # waits for the last heatmap to be written and stops the worker.
+        # anything the job hit is raised, or only reported when training is
+        # already failing so the original error is not replaced
+        future, self._heatmap_future = self._heatmap_future, None
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if future is None:
+            return
+        if raise_errors:
+            future.result()
+        elif future.exception() is not None:
+            print('WARNING there was an error while writing heatmap: %s' %
+                  future.exception())
+
+    def _flush_scalars(self, step):
+        for k, v in self._scalar_buffer.items():
+            self.writer.add_scalar(k, v, step)
+        self._scalar_buffer.clear()
+        self.writer.flush()
+
+    def _copy_to_host(self, tensor):
+        # copies *tensor* into a reused pinned host buffer on the side stream
+        # so the main stream can carry on with the next forward. the caller has
+        # to wait on self._copy_stream before reading the result
+        if not self.gpu:
+            return tensor.cpu()
+
+        buf = self._host_buf
+        if (buf is None or buf.shape != tensor.shape
+                or buf.dtype != tensor.dtype):
+            buf = torch.empty(
+                tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            self._host_buf = buf
+
+        self._copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._copy_stream):
+            buf.copy_(tensor, non_blocking=True)
+        tensor.record_stream(self._copy_stream)
+        return buf
+
+    def _combine_heatmap_with_image(self, image, heatmap, label_name,
+                                    **kwargs):
+        heatmap_image = self._blend_heatmap(image, heatmap).cpu().numpy()
+        return self._draw_label(heatmap_image, label_name, **kwargs)
+
+    def _blend_heatmap(self, image, heatmap):
+        # colour and blend on the heatmap's device, returns an (H, W, 3) uint8
+        # image that is still on that device
+        heatmap = heatmap.detach()
+        image = image.detach().to(heatmap.device)
+        image = (image * 255).clamp(0, 255).to(torch.uint8)
         # get the min and max values once to be used with scaling
         min_val = heatmap.min()
         max_val = heatmap.max()
 
         # Scale the heatmap in range 0-255
         heatmap = (255 * (heatmap - min_val)) / (max_val - min_val + 1e-5)
-        heatmap = heatmap.data.cpu().numpy().astype(np.uint8).transpose((1, 2,
-                                                                         0))
-        heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+        heatmap = heatmap.squeeze(0).to(torch.uint8)
+        heatmap = self._jet_lut.to(heatmap.device)[heatmap.long()]
 
         # generate the heatmap
-        heatmap_image = cv2.addWeighted(image, 0.7, heatmap, 0.3, 0)
+        heatmap_image = 0.7 * image.permute(1, 2, 0) + 0.3 * heatmap
+        return heatmap_image.round().to(torch.uint8)
 
+    @staticmethod
+    def _draw_label(heatmap_image,
+                    label_name,
+                    font_scale=0.75,
+                    font_name=cv2.FONT_HERSHEY_SIMPLEX,
+                    font_color=(255, 255, 255),
+                    font_pixel_width=1):
         # superimpose label_name
         (_, text_size_h), baseline = cv2.getTextSize(
             label_name, font_name, font_scale, font_pixel_width)
@@ -300,21 +428,28 @@ class AttentionGAIN:
             font_scale,
             font_color,
             thickness=font_pixel_width)
-        heatmap_image = cv2.cvtColor(heatmap_image, cv2.COLOR_BGR2RGB)
         return heatmap_image
 
     def generate_heatmap(self, data, label, width=3):
-        data_var, label_var = self._convert_data_and_label(data, label)
-        label_name = self.labels[int(label.max())]
+        data_var, label_var, _, _, present = self._convert_data_and_label(
+            data, [label])
+        label_name = self.labels[int(label.argmax())]
         output_cl, loss_cl, A_c = self._attention_map_forward(
-            data_var, label_var)
-        heatmap = self._combine_heatmap_with_image(data[0], A_c[0], label_name)
+            data_var, label_var, present)
+        heatmap = self._combine_heatmap_with_image(data[0], A_c[0][0],
+                                                   label_name)
         return output_cl, loss_cl, A_c, heatmap
 
-    def forward(self, data, label, extra_super=None, am_mask=None):
-        data, label, extra_super, am_mask = self._convert_data_and_label(
-            data, label, extra_super, am_mask)
-        return self._forward(data, label, extra_super, am_mask)
+    def forward(self,
+                data,
+                label,
+                extra_super=None,
+                am_mask=None,
+                present=None):
+        data, label, extra_super, am_mask, present = \
+            self._convert_data_and_label(
+                data, label, extra_super, am_mask, present)
+        return self._forward(data, label, present, extra_super, am_mask)
 
     def _check_dataset_compatability(self, rds):
         if rds.output_dims != self.input_dims:
@@ -337,7 +472,8 @@ class AttentionGAIN:
               pretrain_epochs=10,
               learning_rate=1e-5,
               test_every_n_epochs=5,
-              num_heatmaps=1):
+              num_heatmaps=1,
+              pbar_every=50):
         # TODO dynamic optimizer selection
         self._check_dataset_compatability(rds)
         self.writer = SummaryWriter(self.saved_model_dir)
@@ -346,220 +482,275 @@ class AttentionGAIN:
         max_acc = 0
         pretrain_finished = False
         opt = torch.optim.Adam(self.model.parameters(), lr=learning_rate)
-        for i in range(self.epoch, epochs, 1):
-            self.epoch = i
-            pretrain_finished = pretrain_finished or \
-                                i > pretrain_epochs
-            loss_cl_sum = 0
-            loss_am_sum = 0
-            acc_cl_sum = 0
-            total_loss_sum = 0
-
-            # train
-            samp_ = 0
-            pbar = tqdm.tqdm(total=len(rds.datasets['train']))
-            train_size = len(rds.datasets['train'])
-
-            for sample in rds.datasets['train']:
-
-                r = self.forward(
-                    sample['image'],
-                    sample['label/onehot'],
-                    extra_super=sample['label/truths'],
-                    am_mask=sample['label/masks'])
-
-                total_loss_sum += scalar(r['total_loss'])
-                loss_cl_sum += scalar(r['loss_cl'])
-                loss_am_sum += scalar(r['loss_am'])
-                acc_cl_sum += scalar(r['cl_acc'])
-
-                samp_ += 1
-
-                # Backprop selectively based on pretraining/training
-                if pretrain_finished:
-                    print_prefix = 'train'
-
-                    r['total_loss'].backward()
-
-                    pbar.set_description('[{}] loss_cl: {:.4f}, loss_am: {:.4f}'.format(
-                        print_prefix,
-                        loss_cl_sum/samp_,
-                        loss_am_sum/samp_))
-                else:
-                    print_prefix = 'pretrain'
-
-                    r['loss_cl'].backward()
-
-                    pbar.set_description('[{}] loss_cl: {:.4f}'.format(
-                        print_prefix,
-                        loss_cl_sum/samp_))
-
-                opt.step()
-                pbar.update(1)
-
-            last_acc = acc_cl_sum / train_size
+        # bfloat16 has the fp32 exponent range, only fp16 needs loss scaling.
+        # torch.amp.GradScaler replaces the deprecated torch.cuda.amp one in
+        # torch >= 2.3, older releases only have the latter
+        use_scaler = self.gpu and self.amp_dtype == torch.float16
+        if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+            scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+        else:
+            scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+        try:
+            for i in range(self.epoch, epochs, 1):
+                self.epoch = i
+                if self.gpu:
+                    torch.cuda.empty_cache()
+                pretrain_finished = pretrain_finished or \
+                                    i > pretrain_epochs
+                # running sums stay on the device so that no iteration has to
+                # wait on a device to host copy
+                loss_cl_sum = torch.zeros((), device=self.device)
+                loss_am_sum = torch.zeros((), device=self.device)
+                acc_cl_sum = torch.zeros((), device=self.device)
+                total_loss_sum = torch.zeros((), device=self.device)
+
+                # train
+                samp_ = 0
+                pbar = tqdm.tqdm(total=len(rds.datasets['train']))
+                train_size = len(rds.datasets['train'])
+
+                for sample in rds.datasets['train']:
 
-            if(pretrain_finished):
-                self.writer.add_scalar('train/loss_am', loss_am_sum/train_size, i+1)
-                self.writer.add_scalar('train/loss', total_loss_sum/train_size, i+1)
-                self.writer.add_scalar('train/avg_acc', last_acc*100.0, i+1)
-                self.writer.add_scalar('train/loss_cl', loss_cl_sum/train_size, i+1)
-                print(
-                    '{} Epoch {}, Loss_CL: {:.4f}, Loss_AM: {:.4f}, Loss Total: {:.4f}, Accuracy_CL: {:.4f}%%'.format(
-                        print_prefix,
-                        (i + 1),
-                        loss_cl_sum / train_size,
-                        loss_am_sum / train_size,
-                        total_loss_sum / train_size,
-                        last_acc * 100.0))
-            else:
-                self.writer.add_scalar('pretrain/loss_cl', loss_cl_sum/train_size, i+1)
-                print(
-                    '{} Epoch {}, Loss_CL: {:.4f}, Accuracy_CL: {:.4f}%'.format(
-                        print_prefix,
-                        (i + 1),
-                        loss_cl_sum / train_size,
-                        last_acc * 100.0))
-
-            samp_ = 0
-            pbar = tqdm.tqdm(total=len(rds.datasets['test']))
-            if (i + 1) % test_every_n_epochs == 0:
-                # test
-                loss_cl_sum = 0
-                loss_am_sum = 0
-                acc_cl_sum = 0
-                total_loss_sum = 0
-                heatmap_count = 0
-                for sample in rds.datasets['test']:
-                    # test
                     r = self.forward(
                         sample['image'],
                         sample['label/onehot'],
                         extra_super=sample['label/truths'],
-                        am_mask=sample['label/masks'])
+                        am_mask=sample['label/masks'],
+                        present=sample.get('label/present'))
 
-                    total_loss_sum += scalar(r['total_loss'])
-                    loss_cl_sum += scalar(r['loss_cl'])
-                    loss_am_sum += scalar(r['loss_am'])
-                    acc_cl_sum += scalar(r['cl_acc'])
+                    total_loss_sum += r['total_loss'].detach().sum()
+                    loss_cl_sum += r['loss_cl'].detach().sum()
+                    loss_am_sum += r['loss_am'].detach().sum()
+                    acc_cl_sum += r['cl_acc'].detach().sum()
 
                     samp_ += 1
-                    pbar.set_description('[test] loss_cl: {:.4f}, loss_am: {:.4f}'.format(
-                        loss_cl_sum/samp_,
-                        loss_am_sum/samp_))
-                    pbar.update(1)
-
-                    if(heatmap_count < num_heatmaps):
-                        self._maybe_save_heatmap(sample['image'][0],
-                                                 sample['label/idx'][0],
-                                                 r['gcams'][0][0],
-                                                 r['I_stars'][0][0],
-                                                 i + 1,
-                                                 heatmap_count)
-                        heatmap_count += 1
-                    self._maybe_save_model('pth',
-                                           tag='default',
-                                           save_count=15)
-
-                test_size = len(rds.datasets['test'])
-                avg_acc = acc_cl_sum / test_size
-                self.writer.add_scalar('test/loss_cl', loss_cl_sum/test_size, i+1)
-                self.writer.add_scalar('test/loss_am', loss_am_sum/test_size, i+1)
-                self.writer.add_scalar('test/loss', total_loss_sum, i+1)
-                self.writer.add_scalar('test/avg_acc', avg_acc*100.0, i+1)
-
-                print(
-                    'TEST Loss_CL: {:.4f}, Loss_AM: {:.4f}, Loss_Total: {:.4f}, Accuracy_CL: {:.4f}%%'.format(
-                        loss_cl_sum / test_size,
-                        loss_am_sum / test_size,
-                        total_loss_sum / test_size,
-                        avg_acc * 100.0))
-
-
-    def _attention_map_forward(self, data, labels):
-        output_cl = self.model(data)
-
-        # attention maps
-        A_cs = []
-        loss_cl = torch.tensor([0.], device=data.device)
 
-        for label in labels:
-
-            grad_target = (output_cl * label).sum()
-            grad_target.backward(gradient=label * output_cl, retain_graph=True)
-
-            # Eq 1
-            w_c = F.avg_pool2d(
-                self._last_grad,
-                (self._last_grad.shape[-2], self._last_grad.shape[-1]), 1)
-            w_c_new_shape = (w_c.shape[0] * w_c.shape[1], w_c.shape[2],
-                             w_c.shape[3])
-            w_c = w_c.view(w_c_new_shape).unsqueeze(0)
-
-            # Eq 2
-            weights = self._last_activation
-            weights_new_shape = (weights.shape[0] * weights.shape[1],
-                                 weights.shape[2], weights.shape[3])
-            weights = weights.view(weights_new_shape).unsqueeze(0)
+                    # Backprop selectively based on pretraining/training
+                    if pretrain_finished:
+                        print_prefix = 'train'
+
+                        scaler.scale(r['total_loss']).backward()
+                    else:
+                        print_prefix = 'pretrain'
+
+                        scaler.scale(r['loss_cl']).backward()
+
+                    scaler.step(opt)
+                    scaler.update()
+
+                    # only sync with the device every *pbar_every* iterations
+                    if samp_ % pbar_every == 0:
+                        loss_cl_avg, loss_am_avg = (
+                            torch.stack((loss_cl_sum, loss_am_sum)) /
+                            samp_).tolist()
+                        if pretrain_finished:
+                            pbar.set_description(
+                                '[{}] loss_cl: {:.4f}, loss_am: {:.4f}'.format(
+                                    print_prefix, loss_cl_avg, loss_am_avg))
+                        else:
+                            pbar.set_description('[{}] loss_cl: {:.4f}'.format(
+                                print_prefix, loss_cl_avg))
+                    pbar.update(1)
 
-            gcam = F.relu(F.conv2d(weights, w_c))
-            A_c = F.upsample(gcam, size=data.size()[2:], mode='bilinear', align_corners=True)
-            A_cs.append(A_c)
+                loss_cl_sum = loss_cl_sum.item()
+                loss_am_sum = loss_am_sum.item()
+                acc_cl_sum = acc_cl_sum.item()
+                total_loss_sum = total_loss_sum.item()
+                last_acc = acc_cl_sum / train_size
+
+                if(pretrain_finished):
+                    self._scalar_buffer['train/loss_am'] = loss_am_sum/train_size
+                    self._scalar_buffer['train/loss'] = total_loss_sum/train_size
+                    self._scalar_buffer['train/avg_acc'] = last_acc*100.0
+                    self._scalar_buffer['train/loss_cl'] = loss_cl_sum/train_size
+                    print(
+                        '{} Epoch {}, Loss_CL: {:.4f}, Loss_AM: {:.4f}, Loss Total: {:.4f}, Accuracy_CL: {:.4f}%%'.format(
+                            print_prefix,
+                            (i + 1),
+                            loss_cl_sum / train_size,
+                            loss_am_sum / train_size,
+                            total_loss_sum / train_size,
+                            last_acc * 100.0))
+                else:
+                    self._scalar_buffer['pretrain/loss_cl'] = loss_cl_sum/train_size
+                    print(
+                        '{} Epoch {}, Loss_CL: {:.4f}, Accuracy_CL: {:.4f}%'.format(
+                            print_prefix,
+                            (i + 1),
+                            loss_cl_sum / train_size,
+                            last_acc * 100.0))
+
+                samp_ = 0
+                pbar = tqdm.tqdm(total=len(rds.datasets['test']))
+                if (i + 1) % test_every_n_epochs == 0:
+                    # test
+                    loss_cl_sum = torch.zeros((), device=self.device)
+                    loss_am_sum = torch.zeros((), device=self.device)
+                    acc_cl_sum = torch.zeros((), device=self.device)
+                    total_loss_sum = torch.zeros((), device=self.device)
+                    heatmap_count = 0
+                    for sample in rds.datasets['test']:
+                        # test
+                        r = self.forward(
+                            sample['image'],
+                            sample['label/onehot'],
+                            extra_super=sample['label/truths'],
+                            am_mask=sample['label/masks'],
+                            present=sample.get('label/present'))
+
+                        total_loss_sum += r['total_loss'].detach().sum()
+                        loss_cl_sum += r['loss_cl'].detach().sum()
+                        loss_am_sum += r['loss_am'].detach().sum()
+                        acc_cl_sum += r['cl_acc'].detach().sum()
+
+                        samp_ += 1
+                        if samp_ % pbar_every == 0:
+                            loss_cl_avg, loss_am_avg = (
+                                torch.stack((loss_cl_sum, loss_am_sum)) /
+                                samp_).tolist()
+                            pbar.set_description(
+                                '[test] loss_cl: {:.4f}, loss_am: {:.4f}'.format(
+                                    loss_cl_avg, loss_am_avg))
+                        pbar.update(1)
+
+                        if(heatmap_count < num_heatmaps):
+                            self._maybe_save_heatmap(sample['image'][0],
+                                                     sample['label/idx'][0][0],
+                                                     r['gcams'][0][0],
+                                                     r['I_stars'][0][0],
+                                                     i + 1,
+                                                     heatmap_count)
+                            heatmap_count += 1
+                        self._maybe_save_model('pth',
+                                               tag='default',
+                                               save_count=15)
+
+                    loss_cl_sum = loss_cl_sum.item()
+                    loss_am_sum = loss_am_sum.item()
+                    acc_cl_sum = acc_cl_sum.item()
+                    total_loss_sum = total_loss_sum.item()
+                    test_size = len(rds.datasets['test'])
+                    avg_acc = acc_cl_sum / test_size
+                    self._scalar_buffer['test/loss_cl'] = loss_cl_sum/test_size
+                    self._scalar_buffer['test/loss_am'] = loss_am_sum/test_size
+                    self._scalar_buffer['test/loss'] = total_loss_sum
+                    self._scalar_buffer['test/avg_acc'] = avg_acc*100.0
 
-            loss_cl += self.loss_cl(output_cl, label)
+                    print(
+                        'TEST Loss_CL: {:.4f}, Loss_AM: {:.4f}, Loss_Total: {:.4f}, Accuracy_CL: {:.4f}%%'.format(
+                            loss_cl_sum / test_size,
+                            loss_am_sum / test_size,
+                            total_loss_sum / test_size,
+                            avg_acc * 100.0))
+
+                self._flush_scalars(i + 1)
+        except BaseException:
+            self._finish_heatmaps(raise_errors=False)
+            raise
+        self._finish_heatmaps()
+
+    def _attention_map_forward(self, data, labels, present):
+        with self._autocast():
+            output_cl = self.model(data)
+        output_cl = output_cl.float()
+        # drop our reference right away so the graph is not kept alive past
+        # this iteration. the activation itself can not be detached, the
+        # attention mining loss backprops through the maps built from it
+        activation = self._last_activation
+        self._last_activation = None
+
+        # labels is stacked as (N, B, C) so the gradients for every label come
+        # out of a single batched backward pass instead of one pass per label.
+        # the graph still has to be retained, loss_cl and the attention mining
+        # loss are backpropagated through it by the caller
+        num_labels, batch_size = labels.shape[:2]
+        grads = torch.autograd.grad(
+            outputs=output_cl,
+            inputs=activation,
+            grad_outputs=labels * output_cl.detach().unsqueeze(0),
+            retain_graph=True,
+            is_grads_batched=True)[0]
+
+        # Eq 1, reduced in fp32 even when the model runs in mixed precision.
+        # the full (N, B, K, H, W) gradient is not needed past this point
+        w_c = grads.float().mean(dim=(-2, -1))
+        del grads
+
+        # Eq 2, contracting the channel dim directly rather than going through
+        # avg_pool2d and a grouped conv2d
+        gcam = F.relu(torch.einsum('bkhw,nbk->nbhw', activation.float(), w_c))
+        out_hw = data.shape[-2:]
+        A_cs = F.interpolate(
+            gcam.flatten(0, 1).unsqueeze(1),
+            size=out_hw, mode='bilinear', align_corners=True)
+        A_cs = A_cs.view(num_labels, batch_size, 1, *out_hw)
+
+        # summed over the labels that are present, averaged over the batch
+        loss_cl = self.loss_cl(output_cl.expand_as(labels), labels).mean(-1)
+        loss_cl = (loss_cl * present).sum() / batch_size
 
         self.model.zero_grad()
 
         return output_cl, loss_cl, A_cs
 
     def _mask_image(self, gcam, image):
-        gcam_min = gcam.min()
-        gcam_max = gcam.max()
-        scaled_gcam = (gcam - gcam_min) / (gcam_max - gcam_min)
-        mask = F.sigmoid(self.omega * (scaled_gcam - self.sigma)).squeeze()
-        masked_image = image - (image * mask)
+        return _mask_image_fused(gcam, image, float(self.omega),
+                                 float(self.sigma))
 
-        return masked_image
+    def _forward(self, data, labels, present, extra_super=None,
+                 am_mask=None):
 
-    def _forward(self, data, labels, extra_super=None, am_mask=None):
-
-        I_stars = []
         loss_e = torch.tensor([0.], device=data.device)
         total_loss = torch.tensor([0.], device=data.device)
 
-        output_cl, loss_cl, gcams = self._attention_map_forward(data, labels)
-        output_cl_softmax = F.softmax(output_cl, dim=1)
+        output_cl, loss_cl, gcams = self._attention_map_forward(
+            data, labels, present)
         total_loss += loss_cl
 
-        if (extra_super is None):
-            extra_super = [None] * len(labels)
-
-        # Eq 3
-        for gcam, label, extra in zip(gcams, labels, extra_super):
-            I_star = self._mask_image(gcam, data)
-            I_stars.append(I_star)
-
-            output_am = self.model(I_star)
-
-            # Eq 5
-            loss_am = F.sigmoid(
-                output_am.view(-1)[label.view(-1).nonzero().view(-1)])
-
-            total_loss += self.alpha * loss_am
-
-            # Eq 7 (extra supervision)
-            if (extra is not None):
-                loss_e = ((gcam - extra)**2).sum()
-                total_loss += self.omega * loss_e
-
-        cl_acc = output_cl_softmax.max(dim=1)[1] == label.max(dim=1)[1]
+        # Eq 3, masking the image with every label's map in one call. gcams is
+        # (N, B, 1, H, W), so this broadcasts to (N, B, C, H, W)
+        I_stars = self._mask_image(gcams, data)
+
+        # the labels are independent, so run the masked images for all of them
+        # through the model as a single (N * B) batch. with batch norm, keep
+        # one forward per label so statistics are still taken over B images
+        num_labels, batch_size = I_stars.shape[:2]
+        with self._autocast():
+            if self._has_batch_norm:
+                output_am = torch.stack(
+                    [self.model(I_star) for I_star in I_stars])
+            else:
+                output_am = self.model(I_stars.flatten(0, 1))
+        output_am = output_am.float().view(num_labels, batch_size, -1)
+        # the hook also fired on this forward, we don't need that activation
+        self._last_activation = None
+
+        # Eq 5, computed over all labels at once on the (N, B, C) stack.
+        # weighting by the one-hot labels picks out the target scores without
+        # the host sync that nonzero() or boolean indexing needs
+        # padded labels are all zero, the presence mask makes that explicit.
+        # like loss_cl this is summed over labels and averaged over the batch
+        loss_am = (torch.sigmoid(output_am) * labels *
+                   present.unsqueeze(-1)).sum() / batch_size
+        total_loss += self.alpha * loss_am
+
+        # Eq 7 (extra supervision)
+        if (extra_super is not None):
+            loss_e = ((gcams - extra_super)**2 *
+                      present.view(*present.shape, 1, 1, 1)).sum() / batch_size
+            total_loss += self.omega * loss_e
+
+        # softmax is monotonic, so the argmax of the logits is enough here.
+        # compared against each sample's last present label
+        last_label = labels[present.sum(0).long() - 1,
+                            torch.arange(labels.shape[1], device=labels.device)]
+        cl_acc = output_cl.argmax(dim=1) == last_label.argmax(dim=1)
         cl_acc = cl_acc.type(self.tensor_source.FloatTensor).mean()
 
         return {'total_loss': total_loss,
                 'loss_cl': loss_cl,
                 'loss_am': loss_am,
                 'loss_e': loss_e,
-                'output_cl_softmax': output_cl_softmax,
                 'cl_acc': cl_acc,
                 'gcams': gcams,
                 'I_stars': I_stars} 
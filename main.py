@@ -35,10 +35,11 @@ def train_handler(args):
         transformer = getattr(transform, args.transformer)()
     rds = data.RawDataset(
         args.dataset_path,
-        num_workers=0,
+        num_workers=args.num_workers,
         output_dims=args.input_dims,
         augmentations=transformer,
-        batch_size_dict=batch_size_dict)
+        batch_size_dict=batch_size_dict,
+        pin_memory=bool(args.gpus))
 
     output_dir = os.path.join(
         args.output_dir,
@@ -54,6 +55,8 @@ def train_handler(args):
         'omega': args.omega,
         'sigma': args.sigma,
         'batch_norm': not args.no_batch_norm,
+        'amp_dtype': args.amp_dtype,
+        'compile_mode': args.compile_mode,
     }
 
     if args.weights_file:
@@ -306,6 +309,20 @@ def parse_args(argv):
         choices=transform.available_transformers,
         default='DropoutAndAffine',
         help='The transformer to use on training data')
+    train_parser.add_argument(
+        '--amp-dtype',
+        type=str,
+        choices=['bfloat16', 'float16'],
+        help=
+        'Run the model forwards under mixed precision with this dtype. Exclude for fp32 training. Only used when training on gpu'
+    )
+    train_parser.add_argument(
+        '--compile-mode',
+        type=str,
+        choices=['default', 'reduce-overhead', 'max-autotune'],
+        help=
+        'Compile the gradient layer with torch.compile using this mode. The layer is compiled with dynamic shapes since the masked pass batch size changes with each sample\'s label count; reduce-overhead still records one CUDA graph per distinct batch size. Requires torch >= 2.0. Exclude to run eagerly'
+    )
     train_parser.add_argument(
         '--serialization-format',
         type=str,
@@ -35,5 +35,8 @@ argv = [
 	gpus
 ]
 
-args = parse_args(argv)
-args.func(args)
+# worker processes re-import this module on spawn platforms (e.g. windows),
+# so training must only start from the main process
+if __name__ == '__main__':
+    args = parse_args(argv)
+    args.func(args)